@@ -9,9 +9,14 @@ Mission Replay Script.  Command-line utility to replay stored missions, includin
 """
 
 import argparse
+import functools
+import hashlib
 import os
+import queue
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 import google.protobuf.wrappers_pb2
 
@@ -31,15 +36,10 @@ from bosdyn.client.robot_command import RobotCommandBuilder, RobotCommandClient,
 from bosdyn.client.robot_state import RobotStateClient
 
 
-def main(raw_args=None):
-    """Replay stored mission"""
-
-    body_lease = None
-
-    # Configure logging
-    bosdyn.client.util.setup_logging()
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+    """Build the command-line argument parser once; it is not modified by parsing"""
 
-    # Parse command-line arguments
     parser = argparse.ArgumentParser()
 
     bosdyn.client.util.add_base_arguments(parser)
@@ -79,7 +79,19 @@ def main(raw_args=None):
     autowalk_parser.add_argument('--autowalk_mission', dest='autowalk_mission_file',
                                  help='Optional alternate Autowalk mission file.')
 
-    args = parser.parse_args(raw_args)
+    return parser
+
+
+def main(raw_args=None):
+    """Replay stored mission"""
+
+    body_lease = None
+
+    # Configure logging
+    bosdyn.client.util.setup_logging()
+
+    # Parse command-line arguments
+    args = _build_parser().parse_args(raw_args)
 
     path_following_mode = map_pb2.Edge.Annotations.PATH_MODE_UNKNOWN
 
@@ -136,6 +148,18 @@ def main(raw_args=None):
             robot.logger.fatal('Unable to find mission file: {}.'.format(mission_file))
         sys.exit(1)
 
+    # Check that the whole map is on disk before taking the lease and standing the robot up. The
+    # graph read here is reused for the upload.
+    graph_data, current_graph = None, None
+    if do_map_load:
+        if not os.path.isdir(map_directory):
+            robot.logger.fatal('Unable to find map directory: %s.', map_directory)
+            sys.exit(1)
+        graph_data, current_graph, missing_files = _find_missing_map_files(robot, map_directory)
+        if missing_files:
+            robot.logger.fatal('Unable to find map files: %s.', ', '.join(missing_files))
+            sys.exit(1)
+
     # Acquire robot lease
     robot.logger.info('Acquiring lease...')
     lease_client = robot.ensure_client(bosdyn.client.lease.LeaseClient.default_service_name)
@@ -146,7 +170,8 @@ def main(raw_args=None):
 
         # Initialize other clients
         robot_state_client, command_client, mission_client, graph_nav_client = init_clients(
-            robot, mission_file, map_directory, do_map_load, args.disable_alternate_route_finding)
+            robot, mission_file, map_directory, do_map_load, args.disable_alternate_route_finding,
+            graph_data, current_graph)
 
         # Turn on power
         power_on(power_client)
@@ -199,27 +224,43 @@ def init_robot(hostname):
     return robot
 
 
-def init_clients(robot, mission_file, map_directory, do_map_load, disable_alternate_route_finding):
-    """Initialize clients"""
+def init_clients(robot, mission_file, map_directory, do_map_load, disable_alternate_route_finding,
+                 graph_data=None, current_graph=None):
+    """Initialize clients.
+
+    graph_data and current_graph are the raw and parsed graph of the map in map_directory. If they
+    are not given, the graph is read from map_directory.
+    """
 
     graph_nav_client = None
     if do_map_load:
-        if not os.path.isdir(map_directory):
-            robot.logger.fatal('Unable to find map directory: {}.'.format(map_directory))
-            sys.exit(1)
-
         # Create graph-nav client
         robot.logger.info('Creating graph-nav client...')
         graph_nav_client = robot.ensure_client(
             bosdyn.client.graph_nav.GraphNavClient.default_service_name)
 
-        # Clear map state and localization
-        robot.logger.info('Clearing graph-nav state...')
-        graph_nav_client.clear_graph()
+        # The same graph bytes identify the map and are parsed for the upload.
+        if graph_data is None or current_graph is None:
+            graph_data, current_graph = _read_graph(robot, map_directory)
+
+        # Skip the upload if this exact map was the last one uploaded to this robot and the robot
+        # still holds it with the options requested for this run.
+        _apply_graph_options(current_graph, disable_alternate_route_finding)
+        digest = _map_digest(map_directory, graph_data, disable_alternate_route_finding)
+        cache_filename = os.path.join(os.path.expanduser('~'), '.cache', 'bosdyn',
+                                      '{}.map'.format(robot.address))
+        if _read_map_cache(cache_filename) == digest and _robot_has_map(
+                graph_nav_client, current_graph):
+            robot.logger.info('Map unchanged, skipping upload.')
+        else:
+            # Clear map state and localization
+            robot.logger.info('Clearing graph-nav state...')
+            graph_nav_client.clear_graph()
 
-        # Upload map to robot
-        upload_graph_and_snapshots(robot, graph_nav_client, map_directory,
-                                   disable_alternate_route_finding)
+            # Upload map to robot
+            upload_graph_and_snapshots(robot, graph_nav_client, map_directory,
+                                       disable_alternate_route_finding, current_graph)
+            _write_map_cache(cache_filename, digest)
 
     # Create mission client
     robot.logger.info('Creating mission client...')
@@ -239,58 +280,161 @@ def init_clients(robot, mission_file, map_directory, do_map_load, disable_altern
     return robot_state_client, command_client, mission_client, graph_nav_client
 
 
+def _map_digest(path, graph_data, disable_alternate_route_finding):
+    """Compute a SHA-256 digest identifying the map in path and how it will be uploaded"""
+
+    digest = hashlib.sha256()
+    digest.update(b'1' if disable_alternate_route_finding else b'0')
+    digest.update(graph_data)
+    for snapshot_dir in ('waypoint_snapshots', 'edge_snapshots'):
+        snapshot_path = os.path.join(path, snapshot_dir)
+        if not os.path.isdir(snapshot_path):
+            continue
+        with os.scandir(snapshot_path) as entries:
+            listing = sorted((entry.name, entry.stat()) for entry in entries)
+        listing = [(name, stat.st_size, stat.st_mtime_ns) for name, stat in listing]
+        digest.update(repr((snapshot_dir, listing)).encode())
+    return digest.hexdigest()
+
+
+def _read_map_cache(filename):
+    """Return the digest of the last map uploaded, or None if unknown"""
+
+    try:
+        with open(filename, 'r', encoding='ascii') as cache_file:
+            return cache_file.read()
+    except OSError:
+        return None
+
+
+def _write_map_cache(filename, digest):
+    """Record the digest of the map just uploaded"""
+
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w', encoding='ascii') as cache_file:
+            cache_file.write(digest)
+    except OSError:
+        pass  # The cache is only an optimization.
+
+
+def _robot_has_map(graph_nav_client, local_graph):
+    """Check that the graph on the robot matches local_graph as it would be uploaded.
+
+    The waypoint ids, the edges and their annotations, and any stored anchoring are compared, so a
+    copy of the same map uploaded by another client with different options does not match.
+    """
+
+    robot_graph = graph_nav_client.download_graph()
+    if robot_graph is None:
+        return False
+    if _graph_summary(robot_graph) != _graph_summary(local_graph):
+        return False
+    # A graph without a stored anchoring gets a new one generated on upload, so only a stored
+    # anchoring can be compared.
+    return not local_graph.anchoring.anchors or robot_graph.anchoring == local_graph.anchoring
+
+
+def _graph_summary(graph):
+    """Return the waypoint ids of a graph and a map from its edge ids to their annotations"""
+
+    waypoint_ids = {waypoint.id for waypoint in graph.waypoints}
+    edge_annotations = {
+        (edge.id.from_waypoint, edge.id.to_waypoint): edge.annotations for edge in graph.edges
+    }
+    return waypoint_ids, edge_annotations
+
+
+def _apply_graph_options(graph, disable_alternate_route_finding):
+    """Apply the command-line options to a graph loaded from disk before it is uploaded"""
+
+    if disable_alternate_route_finding:
+        for edge in graph.edges:
+            edge.annotations.disable_alternate_route_finding = True
+
+
+def _read_graph(robot, map_directory):
+    """Read the graph of the map in map_directory, returning its raw bytes and the parsed Graph"""
+
+    graph_filename = os.path.join(map_directory, 'graph')
+    robot.logger.info('Loading graph from ' + graph_filename)
+    with open(graph_filename, 'rb') as graph_file:
+        graph_data = graph_file.read()
+    graph = map_pb2.Graph()
+    graph.ParseFromString(graph_data)
+    return graph_data, graph
+
+
+def _find_missing_map_files(robot, map_directory):
+    """Find the graph and snapshot files of the map in map_directory that do not exist.
+
+    Returns the raw graph bytes, the parsed Graph and the list of missing files. The graph is None
+    if the graph file itself is missing.
+    """
+
+    graph_filename = os.path.join(map_directory, 'graph')
+    if not os.path.isfile(graph_filename):
+        return None, None, [graph_filename]
+
+    graph_data, graph = _read_graph(robot, map_directory)
+    filenames = [
+        os.path.join(map_directory, 'waypoint_snapshots', waypoint.snapshot_id)
+        for waypoint in graph.waypoints
+        if waypoint.snapshot_id
+    ]
+    filenames.extend(
+        os.path.join(map_directory, 'edge_snapshots', edge.snapshot_id)
+        for edge in graph.edges
+        if edge.snapshot_id)
+
+    # Check the files concurrently so that a slow (e.g. network) filesystem does not add up one
+    # round trip per file.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        exists = list(executor.map(os.path.isfile, filenames))
+    return graph_data, graph, [filename for filename, found in zip(filenames, exists) if not found]
+
+
 def countdown(length):
     """Print sleep countdown"""
 
+    # Sleep until each second's deadline so the time spent printing does not accumulate.
+    end_time = time.monotonic() + length
     for i in range(length, 0, -1):
         print(i, end=' ', flush=True)
-        time.sleep(1)
+        time.sleep(max(0, end_time - (i - 1) - time.monotonic()))
     print(0)
 
 
-def upload_graph_and_snapshots(robot, client, path, disable_alternate_route_finding):
-    """Upload the graph and snapshots to the robot"""
+def _load_proto(filename, proto_cls):
+    """Load a protobuf of type proto_cls from disk"""
 
-    # Load the graph from disk.
-    graph_filename = os.path.join(path, 'graph')
-    robot.logger.info('Loading graph from ' + graph_filename)
+    proto = proto_cls()
+    with open(filename, 'rb') as proto_file:
+        # Tell the kernel the whole file will be read front to back so it can read ahead.
+        # The advice values are not flags, so they are given separately.
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(proto_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(proto_file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        proto.ParseFromString(proto_file.read())
+    return proto
 
-    with open(graph_filename, 'rb') as graph_file:
-        data = graph_file.read()
-        current_graph = map_pb2.Graph()
-        current_graph.ParseFromString(data)
-        robot.logger.info('Loaded graph has {} waypoints and {} edges'.format(
-            len(current_graph.waypoints), len(current_graph.edges)))
 
-    if disable_alternate_route_finding:
-        for edge in current_graph.edges:
-            edge.annotations.disable_alternate_route_finding = True
+def upload_graph_and_snapshots(robot, client, path, disable_alternate_route_finding,
+                               current_graph=None):
+    """Upload the graph and snapshots to the robot.
 
-    # Load the waypoint snapshots from disk.
-    current_waypoint_snapshots = dict()
-    for waypoint in current_graph.waypoints:
-        if len(waypoint.snapshot_id) == 0:
-            continue
-        snapshot_filename = os.path.join(path, 'waypoint_snapshots', waypoint.snapshot_id)
-        robot.logger.info('Loading waypoint snapshot from ' + snapshot_filename)
-
-        with open(snapshot_filename, 'rb') as snapshot_file:
-            waypoint_snapshot = map_pb2.WaypointSnapshot()
-            waypoint_snapshot.ParseFromString(snapshot_file.read())
-            current_waypoint_snapshots[waypoint_snapshot.id] = waypoint_snapshot
-
-    # Load the edge snapshots from disk.
-    current_edge_snapshots = dict()
-    for edge in current_graph.edges:
-        if len(edge.snapshot_id) == 0:
-            continue
-        snapshot_filename = os.path.join(path, 'edge_snapshots', edge.snapshot_id)
-        robot.logger.info('Loading edge snapshot from ' + snapshot_filename)
+    If current_graph is given it is used instead of loading the graph from path again.
+    """
+
+    # Load the graph from disk.
+    if current_graph is None:
+        graph_filename = os.path.join(path, 'graph')
+        robot.logger.info('Loading graph from ' + graph_filename)
+        current_graph = _load_proto(graph_filename, map_pb2.Graph)
+    robot.logger.info('Loaded graph has {} waypoints and {} edges'.format(
+        len(current_graph.waypoints), len(current_graph.edges)))
 
-        with open(snapshot_filename, 'rb') as snapshot_file:
-            edge_snapshot = map_pb2.EdgeSnapshot()
-            edge_snapshot.ParseFromString(snapshot_file.read())
-            current_edge_snapshots[edge_snapshot.id] = edge_snapshot
+    _apply_graph_options(current_graph, disable_alternate_route_finding)
 
     # Upload the graph to the robot.
     robot.logger.info('Uploading the graph and snapshots to the robot...')
@@ -298,16 +442,125 @@ def upload_graph_and_snapshots(robot, client, path, disable_alternate_route_find
     response = client.upload_graph(graph=current_graph, generate_new_anchoring=true_if_empty)
     robot.logger.info('Uploaded graph.')
 
-    # Upload the snapshots to the robot.
-    for snapshot_id in response.unknown_waypoint_snapshot_ids:
-        waypoint_snapshot = current_waypoint_snapshots[snapshot_id]
-        client.upload_waypoint_snapshot(waypoint_snapshot=waypoint_snapshot)
-        robot.logger.info('Uploaded {}'.format(waypoint_snapshot.id))
-
-    for snapshot_id in response.unknown_edge_snapshot_ids:
-        edge_snapshot = current_edge_snapshots[snapshot_id]
-        client.upload_edge_snapshot(edge_snapshot=edge_snapshot)
-        robot.logger.info('Uploaded {}'.format(edge_snapshot.id))
+    # Load the snapshots the robot does not already have on a background thread while uploading
+    # them on this one. The bounded queue keeps only a few snapshots in memory at a time.
+    snapshot_queue = queue.Queue(maxsize=4)
+    stop_loading = threading.Event()
+    producer_errors = []
+    producer = threading.Thread(
+        target=_produce_snapshots,
+        args=(path, response, snapshot_queue, stop_loading, producer_errors), daemon=True)
+    producer.start()
+
+    # GraphNavClient streams each snapshot to the robot as a sequence of DataChunk messages, so
+    # large snapshots never have to fit in a single gRPC message. Snapshots are independent once
+    # the graph is uploaded, so a few are uploaded at once over the shared channel. The number in
+    # flight is capped because each upload holds a serialized copy of its snapshot.
+    max_concurrent_uploads = 4
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_uploads)
+    uploads = {}
+    try:
+        while True:
+            # Surface a failed upload or load as soon as it happens, rather than only when the
+            # queue next yields a snapshot.
+            _collect_uploads(robot, uploads)
+            if producer_errors:
+                raise producer_errors[0]
+            try:
+                kind, snapshot = snapshot_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if snapshot is None:
+                break
+            if kind == 'waypoint':
+                future = executor.submit(client.upload_waypoint_snapshot,
+                                         waypoint_snapshot=snapshot)
+            else:
+                future = executor.submit(client.upload_edge_snapshot, edge_snapshot=snapshot)
+            uploads[future] = snapshot.id
+
+            if len(uploads) >= max_concurrent_uploads:
+                _collect_uploads(robot, uploads, block=True)
+
+        if producer_errors:
+            raise producer_errors[0]
+        for future in as_completed(list(uploads)):
+            future.result()
+            robot.logger.info('Uploaded %s', uploads.pop(future))
+        executor.shutdown()
+    finally:
+        # On failure, abort the uploads that have not started yet and do not wait for the running
+        # ones, so the error is raised right away. Stop the loader and drop whatever it has
+        # queued, so that it is never left blocked on a full queue holding parsed snapshots.
+        for future in uploads:
+            future.cancel()
+        executor.shutdown(wait=False)
+        stop_loading.set()
+        _drain_queue(snapshot_queue)
+        producer.join()
+
+
+def _collect_uploads(robot, uploads, block=False):
+    """Remove finished futures from uploads, re-raising the first failure.
+
+    uploads maps upload futures to snapshot ids. If block is set, wait for at least one upload to
+    finish first.
+    """
+
+    done, _ = wait(uploads, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+    for future in done:
+        future.result()
+        robot.logger.info('Uploaded %s', uploads.pop(future))
+
+
+def _produce_snapshots(path, response, snapshot_queue, stop_event, errors):
+    """Load the snapshots listed in an upload_graph response and put them on snapshot_queue.
+
+    A (None, None) sentinel is put last unless stop_event is set first, in which case loading stops
+    early. Any exception raised while loading is appended to errors.
+    """
+
+    waypoint_snapshot_dir = os.path.join(path, 'waypoint_snapshots')
+    edge_snapshot_dir = os.path.join(path, 'edge_snapshots')
+    snapshot_files = [('waypoint', os.path.join(waypoint_snapshot_dir, snapshot_id),
+                       map_pb2.WaypointSnapshot)
+                      for snapshot_id in response.unknown_waypoint_snapshot_ids]
+    snapshot_files.extend(('edge', os.path.join(edge_snapshot_dir, snapshot_id),
+                           map_pb2.EdgeSnapshot)
+                          for snapshot_id in response.unknown_edge_snapshot_ids)
+    try:
+        for kind, filename, proto_cls in snapshot_files:
+            if stop_event.is_set():
+                return
+            snapshot = _load_proto(filename, proto_cls)
+            if not _put_unless_stopped(snapshot_queue, (kind, snapshot), stop_event):
+                return
+    except Exception as exc:  # pylint: disable=broad-except
+        errors.append(exc)
+    finally:
+        _put_unless_stopped(snapshot_queue, (None, None), stop_event)
+
+
+def _put_unless_stopped(item_queue, item, stop_event, poll_interval=0.1):
+    """Put item on item_queue, giving up if stop_event is set. Returns whether item was put."""
+
+    while not stop_event.is_set():
+        try:
+            item_queue.put(item, timeout=poll_interval)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _drain_queue(item_queue):
+    """Discard everything currently on item_queue"""
+
+    while True:
+        try:
+            item_queue.get_nowait()
+        except queue.Empty:
+            return
 
 
 def upload_mission(robot, client, filename):
@@ -316,10 +569,7 @@ def upload_mission(robot, client, filename):
     # Load the mission from disk
     robot.logger.info('Loading mission from ' + filename)
 
-    with open(filename, 'rb') as mission_file:
-        data = mission_file.read()
-        mission_proto = nodes_pb2.Node()
-        mission_proto.ParseFromString(data)
+    mission_proto = _load_proto(filename, nodes_pb2.Node)
 
     # Upload the mission to the robot
     robot.logger.info('Uploading the mission to the robot...')
@@ -333,7 +583,26 @@ def run_mission(robot, mission_client, lease_client, fail_on_question, mission_t
 
     robot.logger.info('Running mission')
 
-    mission_state = mission_client.get_state()
+    play_settings = mission_pb2.PlaySettings(
+        disable_directed_exploration=disable_directed_exploration,
+        path_following_mode=path_following_mode)
+
+    # Poll quickly while the mission state is changing and back off while it is not, but never
+    # by more than 2s so that a finished mission or a question is still noticed promptly. The
+    # mission only needs to be played again before the previous pause time is reached.
+    min_poll_interval = 0.25
+    max_poll_interval = min(2.0, mission_timeout / 2)
+    poll_interval = min_poll_interval
+    local_pause_time = 0
+    body_lease = None
+
+    # Look up the client methods once rather than on every iteration of the polling loop.
+    get_state = mission_client.get_state
+    play_mission = mission_client.play_mission
+    advance_lease = lease_client.lease_wallet.advance
+
+    mission_state = get_state()
+    last_status, last_questions = None, None
 
     while mission_state.status in (mission_pb2.State.STATUS_NONE, mission_pb2.State.STATUS_RUNNING):
         # We optionally fail if any questions are triggered. This often indicates a problem in
@@ -343,17 +612,28 @@ def run_mission(robot, mission_client, lease_client, fail_on_question, mission_t
                 mission_state.questions))
             return False
 
-        body_lease = lease_client.lease_wallet.advance()
-        local_pause_time = time.time() + mission_timeout
+        questions = list(mission_state.questions)
+        if mission_state.status == last_status and questions == last_questions:
+            poll_interval = min(poll_interval * 1.5, max_poll_interval)
+        else:
+            poll_interval = min_poll_interval
+        last_status, last_questions = mission_state.status, questions
 
-        play_settings = mission_pb2.PlaySettings(
-            disable_directed_exploration=disable_directed_exploration,
-            path_following_mode=path_following_mode)
+        # Pause times are wall-clock times, which the mission client converts to robot time.
+        now = time.time()
+        if local_pause_time - now <= mission_timeout / 2:
+            # Keep playing with the same lease while the mission is still running on it; only
+            # advance it if the mission may already have paused.
+            if body_lease is None or now > local_pause_time - 0.5:
+                body_lease = advance_lease()
+            local_pause_time = now + mission_timeout
+            play_mission(local_pause_time, [body_lease], play_settings)
 
-        mission_client.play_mission(local_pause_time, [body_lease], play_settings)
-        time.sleep(1)
+        # Wake up in time to play the mission again before it pauses.
+        renew_time = local_pause_time - mission_timeout / 2
+        time.sleep(max(0, min(poll_interval, renew_time - now)))
 
-        mission_state = mission_client.get_state()
+        mission_state = get_state()
 
     robot.logger.info('Mission status = ' + mission_state.Status.Name(mission_state.status))
 
@@ -382,11 +662,11 @@ def repeat_mission(robot, mission_client, lease_client, total_time, fail_on_ques
     robot.logger.info('Repeating mission for {} seconds.'.format(total_time))
 
     # Run first mission
-    start_time = time.time()
+    start_time = time.monotonic()
     mission_success = run_mission(robot, mission_client, lease_client, fail_on_question, timeout,
                                   disable_directed_exploration, path_following_mode)
-    elapsed_time = time.time() - start_time
-    robot.logger.info('Elapsed time = {} (out of {})'.format(elapsed_time, total_time))
+    elapsed_time = time.monotonic() - start_time
+    robot.logger.info('Elapsed time = %s (out of %s)', elapsed_time, total_time)
 
     if not mission_success:
         robot.logger.info('Mission failed.')
@@ -398,8 +678,8 @@ def repeat_mission(robot, mission_client, lease_client, total_time, fail_on_ques
         mission_success = run_mission(robot, mission_client, lease_client, fail_on_question,
                                       timeout, disable_directed_exploration, path_following_mode)
 
-        elapsed_time = time.time() - start_time
-        robot.logger.info('Elapsed time = {} (out of {})'.format(elapsed_time, total_time))
+        elapsed_time = time.monotonic() - start_time
+        robot.logger.info('Elapsed time = %s (out of %s)', elapsed_time, total_time)
 
         if not mission_success:
             robot.logger.info('Mission failed.')